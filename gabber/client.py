@@ -1,8 +1,8 @@
-from collections import deque
+import functools
 import os
 import click
 import requests
-from itertools import islice
+import requests_cache
 from datetime import datetime, date, timedelta, timezone
 from loguru import logger
 from requests.sessions import HTTPAdapter
@@ -11,17 +11,24 @@ from typing import Iterable, Iterator, List
 from urllib3 import Retry
 from concurrent import futures
 import random
+import re
 import json
+import orjson
 from concurrent.futures import ThreadPoolExecutor
-from bs4 import BeautifulSoup
 from dateutil.parser import parse as date_parse
-from ratelimit import limits, sleep_and_retry
 
 # Setup loggers
 logger.remove()
 
 REQUESTS_PER_SESSION_REFRESH = 1000
 
+# Responses are cached on disk so that interrupted pulls can be resumed cheaply
+CACHE_PATH = "gabber_cache.sqlite"
+CACHE_EXPIRE_AFTER = 86400  # One day, in seconds
+
+# Output files are written in large chunks rather than line by line
+OUTPUT_BUFFER_SIZE = 1 << 20  # 1 MiB
+
 
 def write_tqdm(*args, **kwargs):
     return tqdm.write(*args, end="", **kwargs)
@@ -39,41 +46,88 @@ headers = {
 GAB_BASE_URL = "https://gab.com"
 GAB_API_BASE_URL = "https://gab.com/api/v1"
 
+# Matches the sign in page's <meta name="csrf-token" content="..."> tag
+CSRF_TOKEN_RE = re.compile(rb'<meta[^>]+name="csrf-token"[^>]+content="([^"]+)"')
+
+# Retry policy shared by all sessions. Rate limiting is reactive: 429s (and friends)
+# are retried with backoff, honoring the server's Retry-After header.
+RETRY = Retry(
+    total=10,
+    backoff_factor=0.5,
+    status_forcelist=[413, 429, 503, 403, 500],
+    allowed_methods=frozenset(["GET"]),
+    respect_retry_after_header=True,
+)
+
+
+def parse_timestamp(value: str) -> datetime:
+    """Parse a Gab timestamp (e.g. 2021-10-02T12:34:56.000Z) into a UTC datetime."""
+
+    try:
+        # Much faster than dateutil for the ISO-8601 timestamps Gab returns
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        parsed = date_parse(value)
+    return parsed.replace(tzinfo=timezone.utc)
+
+
+def pulled_at(response: requests.Response) -> datetime:
+    """When the given response was pulled from Gab, as a naive local time (like datetime.now())."""
+
+    if not getattr(response, "from_cache", False):
+        return datetime.now()
 
-def await_any(items: List[futures.Future], pop=True):
-    done, _not_done = futures.wait(items, return_when=futures.FIRST_COMPLETED)
-    if pop:
-        for item in done:
-            items.remove(item)
-    return done
+    # Cached responses were pulled when they were first stored, not now
+    created_at = response.created_at
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return created_at.astimezone().replace(tzinfo=None)
+
+
+def to_jsonl(records: Iterable[dict]) -> bytes:
+    """Serialize the given records as a single chunk of JSON lines."""
+
+    return b"".join(orjson.dumps(record) + b"\n" for record in records)
 
 
 class Client:
-    def __init__(self, username: str, password: str, threads: int):
+    def __init__(self, username: str, password: str, threads: int, cache: bool = True):
         self.username = username
         self.password = password
         self.threads = threads
+        self.cache = cache
         self._requests_since_refresh = 0
+
+        # One pooled session per client, so connections are reused across requests
+        if cache:
+            self._session = requests_cache.CachedSession(
+                CACHE_PATH,
+                backend="sqlite",
+                expire_after=CACHE_EXPIRE_AFTER,
+                allowable_methods=["GET"],
+                allowable_codes=[200],
+            )
+        else:
+            self._session = requests.Session()
+        self._adapter = HTTPAdapter(
+            max_retries=RETRY, pool_connections=threads, pool_maxsize=threads * 2
+        )
+        self._session.mount("http://", self._adapter)
+        self._session.mount("https://", self._adapter)
+
         if username and password:
             self.sess_cookie = self.get_sess_cookie(username, password)
 
-    # Rate-limited _get function
-    @sleep_and_retry
-    @limits(calls=10, period=1)
-    def _get(self, *args, skip_sess_refresh=False, **kwargs):
-        """Wrapper for requests.get(), except it supports retries."""
+    def _get(self, *args, session=None, skip_sess_refresh=False, **kwargs):
+        """Wrapper for requests.get(), except it supports retries and reuses connections."""
 
-        s = requests.Session()
-        retries = Retry(
-            total=10, backoff_factor=0.5, status_forcelist=[413, 429, 503, 403, 500]
+        response = (session or self._session).get(
+            *args, proxies=proxies, headers=headers, timeout=30, **kwargs
         )
-        s.mount("http://", HTTPAdapter(max_retries=retries))
-        s.mount("https://", HTTPAdapter(max_retries=retries))
-
-        response = s.get(*args, proxies=proxies, headers=headers, timeout=30, **kwargs)
         logger.info(f"GET: {response.url}")
 
-        if not skip_sess_refresh:
+        # Cache hits never reach Gab, so they don't count towards a session refresh
+        if not skip_sess_refresh and not getattr(response, "from_cache", False):
             self._requests_since_refresh += 1
             if self._requests_since_refresh > REQUESTS_PER_SESSION_REFRESH:
                 logger.info(
@@ -84,75 +138,64 @@ class Client:
 
         return response
 
-    def pull_user(self, id: int) -> dict:
-        """Pull the given user's information from Gab. Returns None if not found."""
+    def _fetch_json(self, description: str, *args, **kwargs):
+        """Pull JSON from Gab and stamp each record with _pulled. Returns None on failure."""
 
-        logger.info(f"Pulling user #{id}...")
         try:
-            result = self._get(GAB_API_BASE_URL + f"/accounts/{id}").json()
+            response = self._get(*args, **kwargs)
+            data = orjson.loads(response.content)
         except json.JSONDecodeError as e:
-            logger.error(f"Unable to pull user #{id}: {str(e)}")
+            logger.error(f"Unable to pull {description}: {str(e)}")
             return None
         except Exception as e:
-            logger.error(f"Misc. error while pulling user {id}: {e}")
+            logger.error(f"Misc. error while pulling {description}: {e}")
             return None
 
-        if result.get("error") == "Record not found":
-            return None
+        pulled = pulled_at(response).isoformat()
+        if isinstance(data, dict):
+            if data.get("error") == "Record not found":
+                return None
+            if "error" in data:
+                logger.error(
+                    f"API returned an error while pulling {description}: {data}"
+                )
+                return None
+            data["_pulled"] = pulled
+        elif isinstance(data, list):
+            for record in data:
+                record["_pulled"] = pulled
+
+        return data
 
-        result["_pulled"] = datetime.now().isoformat()
-        return result
+    def pull_user(self, id: int) -> dict:
+        """Pull the given user's information from Gab. Returns None if not found."""
+
+        logger.info(f"Pulling user #{id}...")
+        return self._fetch_json(f"user #{id}", GAB_API_BASE_URL + f"/accounts/{id}")
 
     def pull_group(self, id: int) -> dict:
         """Pull the given group's information from Gab. Returns None if not found."""
 
         logger.info(f"Pulling group #{id}...")
-        try:
-            result = self._get(GAB_API_BASE_URL + f"/groups/{id}").json()
-        except json.JSONDecodeError as e:
-            logger.error(f"Unable to pull group #{id}: {str(e)}")
-            return None
-        except Exception as e:
-            logger.error(f"Misc. error while pulling group #{id}: {e}")
-            return None
-
-        if result.get("error") == "Record not found":
-            return None
-
-        result["_pulled"] = datetime.now().isoformat()
-        return result
+        return self._fetch_json(f"group #{id}", GAB_API_BASE_URL + f"/groups/{id}")
 
     def pull_group_posts(self, id: int, depth: int) -> Iterable[dict]:
         """Pull the given group's posts from Gab."""
 
         page = 1
         while page <= depth:
-            try:
-                results = self._get(
-                    GAB_API_BASE_URL + f"/timelines/group/{id}",
-                    params={
-                        "sort_by": "newest",
-                        "page": page,
-                    },
-                    cookies=self.sess_cookie,
-                ).json()
-            except json.JSONDecodeError as e:
-                logger.error(f"Unable to pull group #{id}'s statuses: {e}")
-                break
-            except Exception as e:
-                logger.error(f"Misc. error while pulling statuses for group #{id}: {e}")
-                break
-
-            if "error" in results:
-                logger.error(
-                    f"API returned an error while pulling group #{id}'s statuses: {results}"
-                )
-                break
-            if len(results) == 0:
+            results = self._fetch_json(
+                f"group #{id}'s statuses",
+                GAB_API_BASE_URL + f"/timelines/group/{id}",
+                params={
+                    "sort_by": "newest",
+                    "page": page,
+                },
+                cookies=self.sess_cookie,
+            )
+            if not results:
                 break
-            for result in results:
-                result["_pulled"] = datetime.now().isoformat()
-                yield result
+            yield from results
             page += 1
 
     def pull_group_and_posts(self, id: int, pull_posts: bool, depth: int) -> dict:
@@ -175,49 +218,46 @@ class Client:
     def pull_statuses(self, id: int, created_after: date, replies: bool) -> List[dict]:
         """Pull the given user's statuses from Gab. Returns an empty list if not found."""
 
+        # Posts created before midnight UTC on created_after are skipped
+        cutoff = (
+            None
+            if created_after is None
+            else datetime(
+                created_after.year,
+                created_after.month,
+                created_after.day,
+                tzinfo=timezone.utc,
+            ).timestamp()
+        )
+
         params = {}
         all_posts = []
         while True:
-            try:
-                url = GAB_API_BASE_URL + f"/accounts/{id}/statuses"
-                if not replies:
-                    url += "?exclude_replies=true"
-                result = self._get(url, params=params, cookies=self.sess_cookie).json()
-            except json.JSONDecodeError as e:
-                logger.error(f"Unable to pull user #{id}'s statuses': {e}")
-                break
-            except Exception as e:
-                logger.error(f"Misc. error while pulling statuses for {id}: {e}")
-                break
-
-            if "error" in result:
-                logger.error(
-                    f"API returned an error while pulling user #{id}'s statuses: {result}"
-                )
-                break
-
-            if len(result) == 0:
+            url = GAB_API_BASE_URL + f"/accounts/{id}/statuses"
+            if not replies:
+                url += "?exclude_replies=true"
+            result = self._fetch_json(
+                f"user #{id}'s statuses", url, params=params, cookies=self.sess_cookie
+            )
+            if not result:
                 break
 
             if not isinstance(result, list):
                 logger.error(f"Result is not a list (it's a {type(result)}): {result}")
 
-            posts = sorted(result, key=lambda k: k["id"])
-            params["max_id"] = posts[0]["id"]
+            # Only the oldest and newest posts matter here, so skip the full sort
+            oldest_post = min(result, key=lambda k: int(k["id"]))
+            newest_post = max(result, key=lambda k: int(k["id"]))
+            params["max_id"] = oldest_post["id"]
 
-            most_recent_date = (
-                date_parse(posts[-1]["created_at"]).replace(tzinfo=timezone.utc).date()
-            )
-            if created_after and most_recent_date < created_after:
+            most_recent = parse_timestamp(newest_post["created_at"]).timestamp()
+            if cutoff is not None and most_recent < cutoff:
                 # Current and all future batches are too old
                 break
 
-            for post in posts:
-                post["_pulled"] = datetime.now().isoformat()
-                date_created = (
-                    date_parse(post["created_at"]).replace(tzinfo=timezone.utc).date()
-                )
-                if created_after and date_created < created_after:
+            for post in result:
+                created = parse_timestamp(post["created_at"]).timestamp()
+                if cutoff is not None and created < cutoff:
                     continue
 
                 all_posts.append(post)
@@ -248,10 +288,15 @@ class Client:
     def find_latest_user(self) -> int:
         """Binary search to find the approximate latest user."""
 
+        # Memoize lookups so no ID is ever requested twice during the search
+        @functools.lru_cache(maxsize=None)
+        def probe(id: int) -> dict:
+            return self.pull_user(id)
+
         lower_bound = 5318531  # Update this from time to time
         logger.debug("Finding upper bound for user search...")
         upper_bound = lower_bound
-        while self.pull_user(upper_bound) != None:
+        while probe(upper_bound) != None:
             logger.debug(f"User {upper_bound} exists; bumping upper bound...")
             upper_bound = round(upper_bound * 1.2)
 
@@ -260,7 +305,7 @@ class Client:
         user = None
         while lower_bound <= upper_bound:
             middle = (lower_bound + upper_bound) // 2
-            middle_user = self.pull_user(middle)
+            middle_user = probe(middle)
             if middle_user is not None:
                 user = middle_user
 
@@ -269,7 +314,9 @@ class Client:
             else:
                 upper_bound = middle - 1
 
-        created_at = date_parse(user["created_at"]).replace(tzinfo=timezone.utc)
+        probe.cache_clear()
+
+        created_at = parse_timestamp(user["created_at"])
         delta = datetime.utcnow().replace(tzinfo=timezone.utc) - created_at
         if delta > timedelta(minutes=30):
             logger.error(
@@ -288,11 +335,17 @@ class Client:
         """Logs in to Gab account and returns the session cookie"""
         url = GAB_BASE_URL + "/auth/sign_in"
         try:
-            login_req = self._get(url, skip_sess_refresh=True)
+            # Sign in on a throwaway (and uncached) session sharing the connection pool,
+            # so cookies collected by the pooled session never leak into the login flow
+            # and the CSRF token is always fresh
+            login_session = requests.Session()
+            login_session.mount("http://", self._adapter)
+            login_session.mount("https://", self._adapter)
+            login_req = self._get(url, session=login_session, skip_sess_refresh=True)
             login_req.raise_for_status()
 
-            login_page = BeautifulSoup(login_req.text, "html.parser")
-            csrf = login_page.find("meta", attrs={"name": "csrf-token"})["content"]
+            match = CSRF_TOKEN_RE.search(login_req.content)
+            csrf = match.group(1).decode() if match else None
             if not csrf:
                 logger.error("Unable to get csrf token from sign in page!")
                 return None
@@ -333,10 +386,15 @@ class Client:
     help="Number of threads to use in the pull (if unspecified, defaults to 25).",
     type=int,
 )
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    help=f"Cache responses on disk (in {CACHE_PATH}) so interrupted pulls can be resumed (defaults to cache).",
+)
 @click.pass_context
-def cli(ctx, user, password, threads):
+def cli(ctx, user, password, threads, cache):
     ctx.ensure_object(dict)
-    ctx.obj["client"] = Client(user, password, threads)
+    ctx.obj["client"] = Client(user, password, threads, cache)
 
 
 @cli.command("posts")
@@ -389,50 +447,54 @@ def posts(
 
     users = iter(range(first, int(last) + 1))
 
-    with open(users_file, "w") as user_file, open(posts_file, "w") as posts_file:
+    with open(users_file, "wb", buffering=OUTPUT_BUFFER_SIZE) as user_file, open(
+        posts_file, "wb", buffering=OUTPUT_BUFFER_SIZE
+    ) as posts_file:
         with ThreadPoolExecutor(max_workers=client.threads) as ex, tqdm(
             total=int(last) + 1 - first
         ) as pbar:
-            # Submit initial work
-            f = list(
-                ex.submit(
-                    client.pull_user_and_posts, user_id, posts, created_after, replies
+            # In-flight pulls, keyed by the user ID each future is pulling
+            in_flight = {}
+
+            def refill():
+                """Keep threads * 2 pulls in flight until we run out of users."""
+                while len(in_flight) < client.threads * 2:
+                    user_id = next(users, None)
+                    if user_id is None:
+                        return
+                    future = ex.submit(
+                        client.pull_user_and_posts,
+                        user_id,
+                        posts,
+                        created_after,
+                        replies,
+                    )
+                    in_flight[future] = user_id
+
+            refill()
+            while len(in_flight) > 0:
+                done, _not_done = futures.wait(
+                    in_flight, return_when=futures.FIRST_COMPLETED
                 )
-                for user_id in islice(users, client.threads * 2)
-            )
-
-            while len(f) > 0:
-                pbar.update(1)
-                try:
-                    done = await_any(f)
-                    for completed in done:
+                for completed in done:
+                    in_flight.pop(completed)
+                    pbar.update(1)
+                    try:
                         (user, found_posts,) = completed.result(
                             0
                         )  # Waits until complete
 
                         if user is not None:
-                            print(json.dumps(user), file=user_file)
-                            for post in found_posts:
-                                print(json.dumps(post), file=posts_file)
-                except Exception as e:
-                    logger.warning(f"Encountered exception in thread pool: {str(e)}")
-                    raise e
+                            user_file.write(orjson.dumps(user) + b"\n")
+                            posts_file.write(to_jsonl(found_posts))
+                    except Exception as e:
+                        logger.warning(
+                            f"Encountered exception in thread pool: {str(e)}"
+                        )
+                        raise e
 
                 # Schedule more work, if available
-                try:
-                    for _ in range(len(done)):
-                        f.append(
-                            ex.submit(
-                                client.pull_user_and_posts,
-                                next(users),
-                                posts,
-                                created_after,
-                                replies,
-                            )
-                        )
-                except StopIteration:
-                    # No more unscheduled users to process
-                    pass
+                refill()
 
 
 @cli.command("groups")
@@ -471,44 +533,48 @@ def groups(
 
     groups = iter(range(first, int(last) + 1))
 
-    with open(groups_file, "w") as groups_file, open(posts_file, "w") as posts_file:
+    with open(groups_file, "wb", buffering=OUTPUT_BUFFER_SIZE) as groups_file, open(
+        posts_file, "wb", buffering=OUTPUT_BUFFER_SIZE
+    ) as posts_file:
         with ThreadPoolExecutor(max_workers=client.threads) as ex, tqdm(
             total=int(last) + 1 - first
         ) as pbar:
-            # Submit initial work
-            f = list(
-                ex.submit(client.pull_group_and_posts, group, posts, depth)
-                for group in islice(groups, client.threads * 2)
-            )
-
-            while len(f) > 0:
-                pbar.update(1)
-                try:
-                    done = await_any(f)
-                    for completed in done:
+            # In-flight pulls, keyed by the group ID each future is pulling
+            in_flight = {}
+
+            def refill():
+                """Keep threads * 2 pulls in flight until we run out of groups."""
+                while len(in_flight) < client.threads * 2:
+                    group = next(groups, None)
+                    if group is None:
+                        return
+                    future = ex.submit(client.pull_group_and_posts, group, posts, depth)
+                    in_flight[future] = group
+
+            refill()
+            while len(in_flight) > 0:
+                done, _not_done = futures.wait(
+                    in_flight, return_when=futures.FIRST_COMPLETED
+                )
+                for completed in done:
+                    in_flight.pop(completed)
+                    pbar.update(1)
+                    try:
                         (group, found_posts,) = completed.result(
                             0
                         )  # Waits until complete
 
                         if group is not None:
-                            print(json.dumps(group), file=groups_file)
-                            for post in found_posts:
-                                print(json.dumps(post), file=posts_file)
-                except Exception as e:
-                    logger.warning(f"Encountered exception in thread pool: {str(e)}")
-                    raise e
+                            groups_file.write(orjson.dumps(group) + b"\n")
+                            posts_file.write(to_jsonl(found_posts))
+                    except Exception as e:
+                        logger.warning(
+                            f"Encountered exception in thread pool: {str(e)}"
+                        )
+                        raise e
 
                 # Schedule more work, if available
-                try:
-                    for _ in range(len(done)):
-                        futures.append(
-                            ex.submit(
-                                client.pull_group_and_posts, next(groups), posts, depth
-                            )
-                        )
-                except StopIteration:
-                    # No more unscheduled groups to process
-                    logger.info("No more groups to process!")
+                refill()
 
 
 def cli_entrypoint():